@@ -2,40 +2,105 @@ import os
 import time
 import yaml
 import argparse
-import collections
 import copy
+import pickle
+import hashlib
+import inspect
 from types import SimpleNamespace as SN
 from utils.utils import mkdir
 from envs import env_REGISTRY
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
 
 def get_config_yaml(path):
     with open(path, "r") as f:
         try:
-            config_dict = yaml.load(f, Loader=yaml.FullLoader)
+            config_dict = yaml.load(f, Loader=Loader)
         except yaml.YAMLError as exc:
             assert False, "default.yaml error: {}".format(exc)
     return config_dict
 
 def recursive_dict_update(d, u):
-    for k, v in u.items():
-        if isinstance(v, collections.Mapping):
-            d[k] = recursive_dict_update(d.get(k, {}), v)
-        else:
-            d[k] = v
+    stack = [(d, u)]
+    while stack:
+        dd, uu = stack.pop()
+        for k, v in uu.items():
+            if isinstance(v, dict) and isinstance(dd.get(k), dict):
+                stack.append((dd[k], v))
+            else:
+                dd[k] = v
     return d
 
 def config_copy(config):
-    if isinstance(config, dict):
+    config_type = type(config)
+    if config_type is dict:
         return {k: config_copy(v) for k, v in config.items()}
-    elif isinstance(config, list):
+    elif config_type is list:
         return [config_copy(v) for v in config]
+    elif config_type in (str, int, float, bool, type(None)):
+        # immutable yaml scalars can be shared
+        return config
     else:
         return copy.deepcopy(config)
 
+# bump to invalidate every cached env info
+ENV_INFO_CACHE_VERSION = 1
+
+def get_env_source_mtime(env_name):
+    """Returns the mtime of the file defining the env class, so editing the env invalidates its cache"""
+    env_class = getattr(env_REGISTRY[env_name], "keywords", {}).get("env")
+    try:
+        return os.path.getmtime(inspect.getfile(env_class))
+    except (TypeError, OSError):
+        return None
+
+def get_env_info(args):
+    """
+    Returns env_info, scheme and groups of the env, cached on disk by env_args and the env source.
+    Files read by the env itself (smac maps, replenishment task configs) are not part of the key,
+    set env_info_cache to False after changing them.
+    """
+    if not getattr(args, "env_info_cache", True):
+        return load_env_info(args)
+    # seed and log path do not change the env info
+    key_args = {k: v for k, v in args.env_args.items() if k not in ("seed", "log_path")}
+    key_items = (ENV_INFO_CACHE_VERSION, get_env_source_mtime(args.env), sorted(key_args.items()))
+    key = hashlib.sha1(repr(key_items).encode()).hexdigest()
+    cache_root_path = os.path.join(os.path.dirname(__file__), ".env_info_cache")
+    cache_path = os.path.join(cache_root_path, f"{args.env}_{key}.pkl")
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    env_info, scheme, groups = load_env_info(args)
+    # write to a temp file first so that concurrent workers never read a partial cache
+    tmp_path = f"{cache_path}.{os.getpid()}"
+    try:
+        mkdir(cache_root_path)
+        with open(tmp_path, "wb") as f:
+            pickle.dump((env_info, scheme, groups), f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # e.g. a read only install, run without the cache
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return env_info, scheme, groups
+
+def load_env_info(args):
+    env = env_REGISTRY[args.env](**args.env_args)
+    env_info = env.get_env_info()
+    scheme, groups = env.get_scheme(env_info)
+    env.close()
+    return env_info, scheme, groups
+
 def update_args(args):
-    # 将时间当前戳转换为自定义格式的字符串
-    formatted_time = time.strftime("%Y%m%d-%H:%M:%S", time.localtime(time.time()))
-    args.unique_token = f"seed{args.seed}_{formatted_time}"
+    # 将时间当前戳转换为自定义格式的字符串, 加上 pid 避免多进程同时启动时重名
+    formatted_time = time.strftime("%Y%m%d-%H%M%S", time.localtime(time.time()))
+    args.unique_token = f"seed{args.seed}_{formatted_time}_{os.getpid()}"
     args.log_path = os.path.join(os.getcwd(), args.log_root_path, args.exp_name, args.algorithm, args.map_name, args.unique_token)
     if args.save_log or args.use_tensorboard:
         mkdir(args.log_path)
@@ -43,18 +108,15 @@ def update_args(args):
         mkdir(args.log_path)
         args.env_args["log_path"] = args.log_path  # for cityflow to save replay file
     # add env info
-    env = env_REGISTRY[args.env](**args.env_args)
-    env_info = env.get_env_info()
+    env_info, scheme, groups = get_env_info(args)
     args.n_agents = env_info["n_agents"]
     args.n_actions = env_info["n_actions"]
     args.state_shape = env_info["state_shape"]
     args.obs_shape = env_info["obs_shape"]
     args.episode_limit = env_info["episode_limit"]
     args.episode_length = env_info["episode_limit"] + 1
-    scheme, groups = env.get_scheme()
     args.scheme = scheme
     args.groups = groups
-    env.close()
     # add address info
     if args.local:
         args.address = "127.0.0.1"
@@ -65,7 +127,7 @@ def update_args(args):
             args.address = os.environ.get("LeaderAddress")
     return args
 
-def get_input_args(configs):
+def parse_input_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--exp_name", type=str, default="test", help="experiment name")
     parser.add_argument("--seed", type=int, default=1, help="seed of the experiment")
@@ -81,7 +143,16 @@ def get_input_args(configs):
     parser.add_argument("--role", type=str, default="train", help="sample or train, when use remote",)
     parser.add_argument("--num_sample_worker", type=int, default=1, help="number of sample worker")
     parser.add_argument("--sampler_id", type=int, default=0, help="when use remote, sampler id for assign port",)
-    args = parser.parse_args()
+    return parser.parse_args()
+
+# command line args are parsed once per process
+_PARSED_ARGS = None
+
+def get_input_args(configs):
+    global _PARSED_ARGS
+    if _PARSED_ARGS is None:
+        _PARSED_ARGS = parse_input_args()
+    args = _PARSED_ARGS
 
     configs["exp_name"] = args.exp_name
     configs["seed"] = args.seed
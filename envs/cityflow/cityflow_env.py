@@ -49,8 +49,9 @@ class CityFlowEnv(MultiAgentEnv):
     def get_avail_actions(self):
         return self._env.get_avail_actions()
 
-    def get_scheme(self):
-        env_info = self.get_env_info()
+    def get_scheme(self, env_info=None):
+        if env_info is None:
+            env_info = self.get_env_info()
 
         scheme = {
             "states": {"vshape": env_info["state_shape"], "dtype": np.float32},
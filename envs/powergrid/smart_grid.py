@@ -498,8 +498,9 @@ class GridEnv(MultiAgentEnv):
 
         return max_adjacent_agents * self.single_agent_obs_size
 
-    def get_scheme(self):
-        env_info = self.get_env_info()
+    def get_scheme(self, env_info=None):
+        if env_info is None:
+            env_info = self.get_env_info()
         scheme = {
             "states": {"vshape": env_info["state_shape"], "dtype": np.float32},
             "obs": {
@@ -285,8 +285,9 @@ class ReplenishmentEnv(MultiAgentEnv):
     def visualize_render(self, visual_output_path):
         return self._env.render()
 
-    def get_scheme(self):
-        env_info = self.get_env_info()
+    def get_scheme(self, env_info=None):
+        if env_info is None:
+            env_info = self.get_env_info()
         scheme = {
             "states": {"vshape": env_info["state_shape"], "dtype": np.float32},
             "obs": {
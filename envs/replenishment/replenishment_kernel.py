@@ -0,0 +1,13 @@
+from numba import njit
+
+
+@njit(cache=True)
+def finalize_step(alive, done, episode_limit, rewards, terminated, step_terminated, episode_returns, episode_lengths):
+    """Per env bookkeeping of a step once every alive env replied, all arrays are updated in place"""
+    for idx in range(alive.shape[0]):
+        if alive[idx]:
+            episode_lengths[idx] += 1
+            episode_returns[idx] += rewards[idx]
+            env_terminated = done[idx] and not episode_limit[idx]
+            terminated[idx] = env_terminated
+            step_terminated[idx] = 1 if env_terminated else 0
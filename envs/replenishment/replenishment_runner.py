@@ -1,40 +1,110 @@
+import pickle
 import numpy as np
-from functools import partial
 from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
 from envs import env_REGISTRY
 
-def env_worker(remote, env_fn):
-    env = env_fn.x()
+# fields written by the worker straight into its shared memory slab
+SHM_FIELDS = ("states", "obs", "available_actions", "individual_rewards")
+# fields returned by every step
+STEP_FIELDS = SHM_FIELDS + ("rewards", "terminated")
+READY = b"\x01"
+
+def get_field_info(args, name):
+    """Returns the per env shape and numpy dtype of a scheme field"""
+    info = args.scheme[name]
+    vshape = info["vshape"]
+    if isinstance(vshape, int):
+        vshape = (vshape,)
+    group = info.get("group", None)
+    if group:
+        vshape = (args.groups[group], *vshape)
+    return vshape, np.dtype(info["dtype"])
+
+def get_field_nbytes(vshape, dtype):
+    # keep every field 8 bytes aligned
+    return (int(np.prod(vshape)) * dtype.itemsize + 7) // 8 * 8
+
+def get_shm_layout(args):
+    """Returns [(name, shape, dtype), ...] of the per-worker shared memory slab and its size in bytes"""
+    layout, size = [], 0
+    for name in SHM_FIELDS:
+        vshape, dtype = get_field_info(args, name)
+        layout.append((name, vshape, dtype))
+        size += get_field_nbytes(vshape, dtype)
+    return layout, size
+
+def get_rollout_layout(shm_layout, n):
+    """Returns the layout and size of a shared memory region holding n steps of every shm field"""
+    layout = [(name, (n, *vshape), dtype) for name, vshape, dtype in shm_layout]
+    return layout, sum(get_field_nbytes(vshape, dtype) for _, vshape, dtype in layout)
+
+def get_shm_views(buf, layout):
+    views, offset = {}, 0
+    for name, vshape, dtype in layout:
+        views[name] = np.ndarray(vshape, dtype=dtype, buffer=buf, offset=offset)
+        offset += get_field_nbytes(vshape, dtype)
+    return views
+
+def env_worker(remote, env_name, env_args_blob, seed, shm_name, shm_layout):
+    env_args = pickle.loads(env_args_blob)
+    env = env_REGISTRY[env_name](**{**env_args, "seed": seed})
+    shm = SharedMemory(name=shm_name)
+    views = get_shm_views(shm.buf, shm_layout)
+    rollout_shm, rollout_views = None, {}
+
+    def write_views(views, env_info=None):
+        np.copyto(views["states"], env.get_state(), casting="unsafe")
+        np.copyto(views["obs"], env.get_obs(), casting="unsafe")
+        np.copyto(views["available_actions"], env.get_avail_actions(), casting="unsafe")
+        if env_info is None:
+            views["individual_rewards"].fill(0)
+        else:
+            # (n_agents,) -> (n_agents, 1), sent through shared memory instead of the info dict
+            individual_rewards = env_info.pop("individual_rewards")
+            np.copyto(views["individual_rewards"][:, 0], individual_rewards, casting="unsafe")
+
     while True:
         cmd, data = remote.recv()
         if cmd == "step":
             actions = data
             reward, terminated, env_info = env.step(actions)
-            state = env.get_state()
-            avail_actions = env.get_avail_actions()
-            obs = env.get_obs()
-            remote.send(
-                {
-                    "state": state,
-                    "available_actions": avail_actions,
-                    "obs": obs,
-                    "reward": reward,
-                    "terminated": terminated,
-                    "info": env_info,
-                }
-            )
+            write_views(views, env_info)
+            remote.send((reward, terminated, env_info))
+        elif cmd == "step_n":
+            # run up to n steps, every step is written into its row of the rollout shared memory
+            actions_seq, n, rollout_shm_name = data
+            if rollout_shm is None or rollout_shm.name != rollout_shm_name:
+                if rollout_shm is not None:
+                    rollout_views.clear()
+                    rollout_shm.close()
+                rollout_shm = SharedMemory(name=rollout_shm_name)
+                rollout_views = get_shm_views(rollout_shm.buf, get_rollout_layout(shm_layout, n)[0])
+            rewards = np.zeros(n, dtype=np.float32)
+            for t in range(n):
+                reward, terminated, env_info = env.step(actions_seq[t])
+                write_views({name: view[t] for name, view in rollout_views.items()}, env_info)
+                rewards[t] = reward
+                if terminated:
+                    break
+            steps = t + 1
+            # the step slab always holds the latest step
+            for name, view in views.items():
+                view[...] = rollout_views[name][steps - 1]
+            remote.send((steps, terminated, env_info, rewards[:steps]))
         elif cmd == "reset":
             env.reset()
-            remote.send(
-                {
-                    "state": env.get_state(),
-                    "avail_actions": env.get_avail_actions(),
-                    "obs": env.get_obs(),
-                }
-            )
+            write_views(views)
+            remote.send_bytes(READY)
         elif cmd == "close":
             env.close()
             remote.close()
+            views.clear()
+            shm.close()
+            if rollout_shm is not None:
+                rollout_views.clear()
+                rollout_shm.close()
             break
         elif cmd == "get_env_info":
             remote.send(env.get_env_info())
@@ -56,22 +126,6 @@ def env_worker(remote, env_fn):
         else:
             raise NotImplementedError
     
-class CloudpickleWrapper:
-    """
-    Uses cloudpickle to serialize contents (otherwise multiprocessing tries to use pickle)
-    """
-
-    def __init__(self, x):
-        self.x = x
-
-    def __getstate__(self):
-        import cloudpickle
-        return cloudpickle.dumps(self.x)
-
-    def __setstate__(self, ob):
-        import pickle
-        self.x = pickle.loads(ob)
-
 class ReplenishmentRunner:
     def __init__(self, args, evaluate=False):
         self.args = args
@@ -83,15 +137,33 @@ class ReplenishmentRunner:
         self._init_env()
     
     def _init_env(self):
+        # numba is only imported by the runner, env workers and other envs never load it
+        from envs.replenishment.replenishment_kernel import finalize_step
+        self.finalize_kernel = finalize_step
+
         self.parent_conns, self.worker_conns = zip(*[Pipe() for _ in range(self.env_batch_size)])
 
-        env_fn = env_REGISTRY[self.args.env]
-        env_args = [self.args.env_args.copy() for _ in range(self.env_batch_size)]
-        for i in range(self.env_batch_size):
-            env_args[i]["seed"] += i
+        # serialize env_args once and pass each worker its seed separately, env_args is never copied or mutated
+        env_args_blob = pickle.dumps(self.args.env_args)
+        base_seed = self.args.env_args["seed"]
+
+        shm_layout, shm_size = get_shm_layout(self.args)
+        self.shm_layout = shm_layout
+        self.shms = [SharedMemory(create=True, size=shm_size) for _ in range(self.env_batch_size)]
+        self.shm_views = [get_shm_views(shm.buf, shm_layout) for shm in self.shms]
+        # allocated by step_n for its rollout length
+        self.rollout_n = 0
+        self.rollout_shms = []
+        self.rollout_views = []
+        # step data is written in place into these batch buffers
+        self.batch_data = {}
+        for name in STEP_FIELDS:
+            vshape, dtype = get_field_info(self.args, name)
+            self.batch_data[name] = np.zeros((self.env_batch_size, *vshape), dtype=dtype)
 
-        self.ps = [Process(target=env_worker, args=(worker_conn, CloudpickleWrapper(partial(env_fn, **env_arg))))
-                   for env_arg, worker_conn in zip(env_args, self.worker_conns)]
+        self.ps = [Process(target=env_worker, args=(worker_conn, self.args.env, env_args_blob, base_seed + i,
+                                                    shm.name, shm_layout))
+                   for i, (worker_conn, shm) in enumerate(zip(self.worker_conns, self.shms))]
 
         for p in self.ps:
             p.daemon = True
@@ -105,8 +177,15 @@ class ReplenishmentRunner:
         self.terminated = np.ones(self.env_batch_size, dtype=np.bool_)
         self.envs_step = np.zeros(self.env_batch_size, dtype=np.int32)
 
-        self.episode_returns = [0.] * self.env_batch_size
-        self.episode_lengths = [0] * self.env_batch_size
+        self.episode_returns = np.zeros(self.env_batch_size, dtype=np.float64)
+        self.episode_lengths = np.zeros(self.env_batch_size, dtype=np.int64)
+        # flags gathered while receiving, consumed by finalize_step
+        self.received_done = np.zeros(self.env_batch_size, dtype=np.bool_)
+        self.received_episode_limit = np.zeros(self.env_batch_size, dtype=np.bool_)
+        # fake data of terminated envs, only written into the batch once per termination
+        self.fake_data = {name: np.zeros_like(data[0]) for name, data in self.batch_data.items()}
+        self.fake_data["available_actions"].fill(1)
+        self.fake_filled = np.zeros(self.env_batch_size, dtype=np.bool_)
         
     def reset_all_env(self):
         self.envs_step = np.zeros(self.env_batch_size, dtype=np.int32)
@@ -115,122 +194,177 @@ class ReplenishmentRunner:
         
     def sync_step(self, actions=None):
         terminated_env_info = []
-        step_data = {
-            "states": [],
-            "available_actions": [],
-            "obs": [],
-            "rewards": [],
-            "individual_rewards": [],
-            "terminated": [],
-        }
+        step_data = self.batch_data
         if np.all(self.terminated):
             self.envs_step[:] = 0
             for parent_conn in self.parent_conns:
                 parent_conn.send(("reset", None))
 
             for idx, parent_conn in enumerate(self.parent_conns):
-                data = parent_conn.recv()
-                step_data["rewards"].append((0.,))
-                step_data["individual_rewardss"].append(np.zeros((self.args.n_agents, 1)))
-                step_data["terminated"].append((False,))
-                step_data["states"].append(data["state"])
-                step_data["available_actions"].append(data["avail_actions"])
-                step_data["obs"].append(data["obs"])
+                parent_conn.recv_bytes()
+                self.read_shm(idx)
+            step_data["rewards"].fill(0)
+            step_data["terminated"].fill(0)
             self.terminated[:] = False
         else:
-            for idx, parent_conn in enumerate(self.parent_conns):
-                if not self.terminated[idx]:
-                    parent_conn.send(("step", actions[idx]))
-                    self.envs_step[idx] += 1
-                    self.env_total_steps += 1
-            for idx, parent_conn in enumerate(self.parent_conns):
-                if not self.terminated[idx]:
-                    data = parent_conn.recv()
-                    step_data["rewards"].append((data["reward"],))
-                    step_data["individual_rewardss"].append(np.expand_dims(data["info"].pop("individual_rewards"), axis=-1))
-                    self.episode_lengths[idx] += 1
-                    self.episode_returns[idx] += data["reward"]
-                    env_terminated = False
-
-                    if data["terminated"]:
-                        terminated_env_info.append(self.get_terminated_env_info(idx, data["info"]))
-
-                    if data["terminated"] and not data["info"].get("episode_limit", False):
-                        env_terminated = True
-                    self.terminated[idx] = env_terminated
-                    step_data["terminated"].append((env_terminated,))
-                    step_data["states"].append(data["state"])
-                    step_data["available_actions"].append(data["avail_actions"])
-                    step_data["obs"].append(data["obs"])
-                else:
-                    # add fake data
-                    step_data["state"].append(np.zeros(self.args.state_shape))
-                    step_data["avail_actions"].append(np.ones((self.args.n_agents, self.args.n_actions)))
-                    step_data["obs"].append(np.zeros((self.args.n_agents, self.args.obs_shape)))
-                    step_data["reward"].append((0.,))
-                    step_data["terminated"].append((False,))
-                    step_data["individual_rewards"].append(np.zeros((self.args.n_agents, 1)))
-                    self.envs_step[idx] = 0
-
-        for k, v in step_data.items():
-            step_data[k] = np.array(v)
+            alive = ~self.terminated
+            alive_list = alive.tolist()
+            for alive_env, parent_conn, env_actions in zip(alive_list, self.parent_conns, actions):
+                if alive_env:
+                    parent_conn.send(("step", env_actions))
+            self.envs_step += alive
+            self.envs_step[~alive] = 0
+            self.env_total_steps += int(alive.sum())
+            self.received_done.fill(False)
+            self.received_episode_limit.fill(False)
+            done_infos = {}
+            pending = {}
+            for idx, (alive_env, parent_conn) in enumerate(zip(alive_list, self.parent_conns)):
+                if alive_env:
+                    pending[parent_conn] = idx
+                elif not self.fake_filled[idx]:
+                    # add fake data, the slot keeps it until the env is reset
+                    for name, fake in self.fake_data.items():
+                        step_data[name][idx] = fake
+                    self.fake_filled[idx] = True
+            # unpack envs in the order they finish
+            while pending:
+                for parent_conn in wait(list(pending)):
+                    self.recv_step(pending.pop(parent_conn), parent_conn, done_infos)
+            self.finalize_step(alive, done_infos, terminated_env_info)
 
         return step_data, terminated_env_info
 
     def async_step(self, actions=None):
         terminated_env_info = []
+        step_data = self.batch_data
 
-        step_data = {
-            "state": [],
-            "avail_actions": [],
-            "obs": [],
-            "reward": [],
-            "terminated": [],
-            "individual_rewards": [],
-        }
-
-        for idx, parent_conn in enumerate(self.parent_conns):
-            if not self.terminated[idx]:
+        alive = ~self.terminated
+        alive_list = alive.tolist()
+        for idx, (alive_env, parent_conn) in enumerate(zip(alive_list, self.parent_conns)):
+            if alive_env:
                 parent_conn.send(("step", actions[idx]))
-                self.envs_step[idx] += 1
             else:
                 parent_conn.send(("reset", None))
-                self.envs_step[idx] = 0
+        self.envs_step += alive
+        self.envs_step[~alive] = 0
+        self.env_total_steps += self.env_batch_size
 
-        for idx, parent_conn in enumerate(self.parent_conns):
-            data = parent_conn.recv()
-            self.env_total_steps += 1
+        self.received_done.fill(False)
+        self.received_episode_limit.fill(False)
+        done_infos = {}
+        pending = {parent_conn: idx for idx, parent_conn in enumerate(self.parent_conns)}
+        # unpack envs in the order they finish
+        while pending:
+            for parent_conn in wait(list(pending)):
+                idx = pending.pop(parent_conn)
+                if alive_list[idx]:
+                    self.recv_step(idx, parent_conn, done_infos)
+                else:
+                    parent_conn.recv_bytes()
+                    self.read_shm(idx)
+                    step_data["rewards"][idx] = 0
+                    step_data["terminated"][idx] = False
+        self.finalize_step(alive, done_infos, terminated_env_info)
+        self.terminated[~alive] = False
+
+        return step_data, terminated_env_info
 
+    def recv_step(self, idx, parent_conn, done_infos):
+        reward, terminated, info = parent_conn.recv()
+        self.read_shm(idx)
+        self.batch_data["rewards"][idx] = reward
+        if terminated:
+            self.received_done[idx] = True
+            self.received_episode_limit[idx] = info.get("episode_limit", False)
+            done_infos[idx] = info
+
+    def finalize_step(self, alive, done_infos, terminated_env_info):
+        self.finalize_kernel(alive, self.received_done, self.received_episode_limit, self.batch_data["rewards"][:, 0],
+                             self.terminated, self.batch_data["terminated"][:, 0], self.episode_returns, self.episode_lengths)
+        for idx in sorted(done_infos):
+            terminated_env_info.append(self.get_terminated_env_info(idx, done_infos[idx]))
+
+    def step_n(self, actions_seq, n):
+        """
+        Runs up to n steps in every alive env with one round trip per env.
+        actions_seq: (env_batch_size, n, n_agents), the actions of the next n steps.
+        Returns data of shape (env_batch_size, n, ...), the number of steps run by each env and terminated env info.
+        Envs stop early on termination, their remaining steps are filled with zeros.
+        batch_data is left holding the last step of every env, so step_n and step can be mixed.
+        """
+        if n < 1:
+            raise ValueError(f"step_n needs n >= 1, got {n}")
+        if n != self.rollout_n:
+            self.init_rollout_shm(n)
+        terminated_env_info = []
+        rollout_data = {}
+        for name, data in self.batch_data.items():
+            if name == "terminated":
+                continue
+            rollout_data[name] = np.zeros((self.env_batch_size, n, *data.shape[1:]), dtype=data.dtype)
+        rollout_data["terminated"] = np.zeros((self.env_batch_size, n, 1), dtype=self.batch_data["terminated"].dtype)
+        rollout_steps = np.zeros(self.env_batch_size, dtype=np.int32)
+
+        for idx, parent_conn in enumerate(self.parent_conns):
             if not self.terminated[idx]:
-                step_data["reward"].append((data["reward"],))
-                step_data["individual_rewards"].append(np.expand_dims(data["info"]["individual_rewards"], axis=-1))
-                self.episode_lengths[idx] += 1
-                self.episode_returns[idx] += data["reward"]
-                env_terminated = False
-
-                if data["terminated"]:
-                    terminated_env_info.append(self.get_terminated_env_info(idx, data["info"]))
-
-                if data["terminated"] and not data["info"].get("episode_limit", False):
-                    env_terminated = True
-                self.terminated[idx] = env_terminated
-                step_data["terminated"].append((env_terminated,))
-                step_data["state"].append(data["state"])
-                step_data["avail_actions"].append(data["avail_actions"])
-                step_data["obs"].append(data["obs"])
-            else:
-                step_data["reward"].append((0.,))
-                step_data["terminated"].append((False,))
-                step_data["individual_rewards"].append(np.zeros((self.args.n_agents, 1)))
-                step_data["state"].append(data["state"])
-                step_data["avail_actions"].append(data["avail_actions"])
-                step_data["obs"].append(data["obs"])
-                self.terminated[idx] = False
+                parent_conn.send(("step_n", (actions_seq[idx], n, self.rollout_shms[idx].name)))
+        self.envs_step[self.terminated] = 0
 
-        for k, v in step_data.items():
-            step_data[k] = np.array(v)
+        for idx, parent_conn in enumerate(self.parent_conns):
+            if self.terminated[idx]:
+                if not self.fake_filled[idx]:
+                    # add fake data, the slot keeps it until the env is reset
+                    for name, fake in self.fake_data.items():
+                        self.batch_data[name][idx] = fake
+                    self.fake_filled[idx] = True
+                continue
+            steps, terminated, info, rewards = parent_conn.recv()
+            self.read_shm(idx)
+            for name, view in self.rollout_views[idx].items():
+                rollout_data[name][idx, :steps] = view[:steps]
+            rollout_data["rewards"][idx, :steps, 0] = rewards
+            rollout_steps[idx] = steps
+            self.envs_step[idx] += steps
+            self.env_total_steps += steps
+            self.episode_lengths[idx] += steps
+            self.episode_returns[idx] += float(rewards.sum())
+            env_terminated = False
 
-        return step_data, terminated_env_info
+            if terminated:
+                terminated_env_info.append(self.get_terminated_env_info(idx, info))
+
+            if terminated and not info.get("episode_limit", False):
+                env_terminated = True
+            self.terminated[idx] = env_terminated
+            rollout_data["terminated"][idx, steps - 1] = env_terminated
+            # batch_data holds the last step, like after step
+            self.batch_data["rewards"][idx] = rewards[steps - 1]
+            self.batch_data["terminated"][idx] = env_terminated
+
+        return rollout_data, rollout_steps, terminated_env_info
+
+    def init_rollout_shm(self, n):
+        """(Re)allocates the per worker shared memory that step_n writes n steps into"""
+        self.close_rollout_shm()
+        layout, size = get_rollout_layout(self.shm_layout, n)
+        self.rollout_shms = [SharedMemory(create=True, size=size) for _ in range(self.env_batch_size)]
+        self.rollout_views = [get_shm_views(shm.buf, layout) for shm in self.rollout_shms]
+        self.rollout_n = n
+
+    def close_rollout_shm(self):
+        # workers attached to the old region keep their mapping until they switch to the new name
+        self.rollout_views = []
+        for shm in self.rollout_shms:
+            shm.close()
+            shm.unlink()
+        self.rollout_shms = []
+        self.rollout_n = 0
+
+    def read_shm(self, idx):
+        for name, view in self.shm_views[idx].items():
+            self.batch_data[name][idx] = view
+        self.fake_filled[idx] = False
 
     def alive_env(self):
         return int(np.sum(self.terminated == False))
@@ -238,15 +372,24 @@ class ReplenishmentRunner:
     def close_env(self):
         for parent_conn in self.parent_conns:
             parent_conn.send(("close", None))
+        for p in self.ps:
+            p.join()
+        for parent_conn in self.parent_conns:
+            parent_conn.close()
+        self.close_rollout_shm()
+        self.shm_views = None
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
 
     def get_terminated_env_info(self, env_idx, env_info):
         terminated_env_info = {}
-        terminated_env_info["episode_length"] = self.episode_lengths[env_idx]
-        terminated_env_info["episode_return"] = self.episode_returns[env_idx]
+        terminated_env_info["episode_length"] = int(self.episode_lengths[env_idx])
+        terminated_env_info["episode_return"] = float(self.episode_returns[env_idx])
         self.episode_lengths[env_idx] = 0
         self.episode_returns[env_idx] = 0
-        terminated_env_info.update(
-            {k: terminated_env_info.get(k, 0) + env_info.get(k, 0) for k in set(terminated_env_info) | set(env_info)})
+        for k, v in env_info.items():
+            terminated_env_info[k] = terminated_env_info.get(k, 0) + v
         if self.evaluate:
             current_env_info = {}
             for k, v in terminated_env_info.items():
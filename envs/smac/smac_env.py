@@ -14,9 +14,17 @@ class BaseEnv:
 class SMAC(StarCraft2Env):
     def __init__(self, **kwargs):
         super(SMAC, self).__init__(**kwargs)
+        self._env_info_cache = None
 
-    def get_scheme(self):
-        env_info = super().get_env_info()
+    def get_env_info(self):
+        # env info of a map never changes, avoid querying StarCraft II again
+        if self._env_info_cache is None:
+            self._env_info_cache = super().get_env_info()
+        return self._env_info_cache
+
+    def get_scheme(self, env_info=None):
+        if env_info is None:
+            env_info = self.get_env_info()
         scheme = {
             "states": {"vshape": env_info["state_shape"], "dtype": np.float32},
             "obs": {
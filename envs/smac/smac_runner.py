@@ -1,10 +1,11 @@
+import pickle
 import numpy as np
-from functools import partial
 from multiprocessing import Pipe, Process
 from envs import env_REGISTRY
 
-def env_worker(remote, env_fn):
-    env = env_fn.x()
+def env_worker(remote, env_name, env_args_blob, seed):
+    env_args = pickle.loads(env_args_blob)
+    env = env_REGISTRY[env_name](**{**env_args, "seed": seed})
     while True:
         cmd, data = remote.recv()
         if cmd == "step":
@@ -39,19 +40,6 @@ def env_worker(remote, env_fn):
         else:
             raise NotImplementedError
         
-class CloudpickleWrapper():
-
-    def __init__(self, x):
-        self.x = x
-
-    def __getstate__(self):
-        import cloudpickle
-        return cloudpickle.dumps(self.x)
-
-    def __setstate__(self, ob):
-        import pickle
-        self.x = pickle.loads(ob)
-
 class SMACRunner:
     def __init__(self, args, evaluate=False):
         self.args = args
@@ -65,13 +53,12 @@ class SMACRunner:
     def _init_env(self):
         self.parent_conns, self.worker_conns = zip(*[Pipe() for _ in range(self.env_batch_size)])
 
-        env_fn = env_REGISTRY[self.args.env]
-        env_args = [self.args.env_args.copy() for _ in range(self.env_batch_size)]
-        for i in range(self.env_batch_size):
-            env_args[i]["seed"] += i
+        # serialize env_args once and pass each worker its seed separately, env_args is never copied or mutated
+        env_args_blob = pickle.dumps(self.args.env_args)
+        base_seed = self.args.env_args["seed"]
 
-        self.ps = [Process(target=env_worker, args=(worker_conn, CloudpickleWrapper(partial(env_fn, **env_arg))))
-                   for env_arg, worker_conn in zip(env_args, self.worker_conns)]
+        self.ps = [Process(target=env_worker, args=(worker_conn, self.args.env, env_args_blob, base_seed + i))
+                   for i, worker_conn in enumerate(self.worker_conns)]
 
         for p in self.ps:
             p.daemon = True
@@ -88,6 +75,11 @@ class SMACRunner:
         self.episode_returns = [0] * self.env_batch_size
         self.episode_lengths = [0] * self.env_batch_size
 
+        # fake data of terminated envs, shared by every step since np.array copies it into the batch
+        self.fake_state = np.zeros(self.args.state_shape)
+        self.fake_avail_actions = np.ones((self.args.n_agents, self.args.n_actions))
+        self.fake_obs = np.zeros((self.args.n_agents, self.args.obs_shape))
+
     def reset_all_env(self):
         self.envs_step = np.zeros(self.env_batch_size, dtype=np.int32)
         self.terminated = np.ones(self.env_batch_size, dtype=np.bool_)
@@ -144,9 +136,9 @@ class SMACRunner:
                     # add fake data
                     step_data["rewards"].append((0.,))
                     step_data["terminated"].append((False,))
-                    step_data["states"].append(np.zeros(self.args.state_shape))
-                    step_data["available_actions"].append(np.ones((self.args.n_agents, self.args.n_actions)))
-                    step_data["obs"].append(np.zeros((self.args.n_agents, self.args.obs_shape)))
+                    step_data["states"].append(self.fake_state)
+                    step_data["available_actions"].append(self.fake_avail_actions)
+                    step_data["obs"].append(self.fake_obs)
                     self.envs_step[idx] = 0
 
         for k, v in step_data.items():
@@ -222,8 +214,8 @@ class SMACRunner:
         terminated_env_info["episode_return"] = self.episode_returns[env_idx]
         self.episode_lengths[env_idx] = 0
         self.episode_returns[env_idx] = 0
-        terminated_env_info.update(
-            {k: terminated_env_info.get(k, 0) + env_info.get(k, 0) for k in set(terminated_env_info) | set(env_info)})
+        for k, v in env_info.items():
+            terminated_env_info[k] = terminated_env_info.get(k, 0) + v
         if self.evaluate:
             current_env_info = {}
             for k, v in terminated_env_info.items():
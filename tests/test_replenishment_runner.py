@@ -0,0 +1,121 @@
+import unittest
+import multiprocessing as mp
+from types import SimpleNamespace as SN
+from unittest import mock
+import numpy as np
+from envs import env_REGISTRY
+from envs.replenishment import replenishment_runner
+from envs.replenishment.replenishment_runner import ReplenishmentRunner
+
+N_AGENTS = 2
+N_ACTIONS = 3
+
+
+class StubEnv:
+    """Returns reward t at step t and terminates after 2 + 5 * seed steps"""
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.episode_length = 2 + 5 * seed
+        self.t = 0
+
+    def reset(self):
+        self.t = 0
+
+    def step(self, actions):
+        self.t += 1
+        env_info = {"individual_rewards": np.full(N_AGENTS, self.t, dtype=np.float32)}
+        return float(self.t), self.t >= self.episode_length, env_info
+
+    def get_state(self):
+        return np.full(4, self.t, dtype=np.float32)
+
+    def get_obs(self):
+        return [np.full(3, self.t, dtype=np.float32)] * N_AGENTS
+
+    def get_avail_actions(self):
+        return [[1] * N_ACTIONS] * N_AGENTS
+
+    def close(self):
+        pass
+
+
+def get_args():
+    scheme = {
+        "states": {"vshape": 4, "dtype": np.float32},
+        "obs": {"vshape": 3, "group": "agents", "dtype": np.float32},
+        "available_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": np.int32},
+        "rewards": {"vshape": (1,), "dtype": np.float32},
+        "individual_rewards": {"vshape": (1,), "group": "agents", "dtype": np.float32},
+        "terminated": {"vshape": (1,), "dtype": np.int32},
+    }
+    return SN(env="stub", env_args={"seed": 0}, scheme=scheme, groups={"agents": N_AGENTS}, env_batch_size=2,
+              asynchronous_env=False)
+
+
+class TestStepN(unittest.TestCase):
+    def setUp(self):
+        # fork so the workers see the stub registered below
+        patches = [mock.patch.dict(env_REGISTRY, {"stub": StubEnv}),
+                   mock.patch.object(replenishment_runner, "Process", mp.get_context("fork").Process)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.runner = ReplenishmentRunner(get_args())
+        self.addCleanup(self.runner.close_env)
+
+    def actions(self, n):
+        return np.zeros((2, n, N_AGENTS), dtype=np.int64)
+
+    def test_step_n_then_sync_step(self):
+        runner = self.runner
+        # reset, env 0 runs 2 steps per episode and env 1 runs 7
+        runner.step(None)
+
+        data, steps, terminated_env_info = runner.step_n(self.actions(3), 3)
+        np.testing.assert_array_equal(steps, [2, 3])
+        np.testing.assert_array_equal(data["rewards"][:, :, 0], [[1, 2, 0], [1, 2, 3]])
+        np.testing.assert_array_equal(data["terminated"][:, :, 0], [[0, 1, 0], [0, 0, 0]])
+        np.testing.assert_array_equal(data["states"][1, :, 0], [1, 2, 3])
+        np.testing.assert_array_equal(data["individual_rewards"][0, :, 0, 0], [1, 2, 0])
+        self.assertEqual(terminated_env_info, [{"episode_length": 2, "episode_return": 3.0}])
+        np.testing.assert_array_equal(runner.terminated, [True, False])
+        np.testing.assert_array_equal(runner.envs_step, [2, 3])
+        np.testing.assert_array_equal(runner.batch_data["rewards"][:, 0], [2, 3])
+        np.testing.assert_array_equal(runner.batch_data["terminated"][:, 0], [1, 0])
+        np.testing.assert_array_equal(runner.batch_data["states"][:, 0], [2, 3])
+
+        # a different n reallocates the rollout shared memory, the terminated env gets fake data
+        data, steps, terminated_env_info = runner.step_n(self.actions(2), 2)
+        np.testing.assert_array_equal(steps, [0, 2])
+        np.testing.assert_array_equal(data["rewards"][:, :, 0], [[0, 0], [4, 5]])
+        self.assertEqual(terminated_env_info, [])
+        np.testing.assert_array_equal(runner.envs_step, [0, 5])
+        np.testing.assert_array_equal(runner.batch_data["rewards"][:, 0], [0, 5])
+        np.testing.assert_array_equal(runner.batch_data["terminated"][:, 0], [0, 0])
+        np.testing.assert_array_equal(runner.batch_data["states"][:, 0], [0, 5])
+        np.testing.assert_array_equal(runner.batch_data["available_actions"][0], np.ones((N_AGENTS, N_ACTIONS)))
+
+        # step continues the episode where step_n left it
+        step_data, terminated_env_info = runner.step(self.actions(1)[:, 0])
+        np.testing.assert_array_equal(runner.envs_step, [0, 6])
+        np.testing.assert_array_equal(step_data["rewards"][:, 0], [0, 6])
+        self.assertEqual(terminated_env_info, [])
+        step_data, terminated_env_info = runner.step(self.actions(1)[:, 0])
+        np.testing.assert_array_equal(step_data["terminated"][:, 0], [0, 1])
+        self.assertEqual(terminated_env_info, [{"episode_length": 7, "episode_return": 28.0}])
+
+        # every env is done, the next step resets them all
+        step_data, terminated_env_info = runner.step(None)
+        np.testing.assert_array_equal(runner.terminated, [False, False])
+        np.testing.assert_array_equal(runner.envs_step, [0, 0])
+        np.testing.assert_array_equal(step_data["rewards"][:, 0], [0, 0])
+
+    def test_step_n_needs_positive_n(self):
+        self.runner.step(None)
+        with self.assertRaises(ValueError):
+            self.runner.step_n(self.actions(1), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()